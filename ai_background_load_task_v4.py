@@ -12,11 +12,18 @@ Design:
 Author: Neha Gajbhiye
 Status: Research prototype
 """
-from psychopy import visual, core, event, gui, data
-import random
+from psychopy import core, gui
 import os
-import csv
+import gc
+import glob
+import json
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from enum import IntEnum
+from itertools import product
+from pathlib import Path
 
 # =========================
 # Experiment Info
@@ -30,6 +37,14 @@ dlg = gui.DlgFromDict(exp_info, title="AI Background Load Task")
 if not dlg.OK:
     core.quit()
 
+# The visual/OpenGL stack and the data libraries are only imported once the
+# dialog has been accepted, so showing (or cancelling) it stays fast.
+from psychopy import visual, event
+from psychopy.hardware import keyboard
+import numpy as np
+import pandas as pd
+from PIL import Image
+
 # =========================
 # Window Setup
 # =========================
@@ -38,9 +53,31 @@ win = visual.Window(
     size=[1280, 720],
     fullscr=True,
     units="pix",
-    color=[0, 0, 0]
+    color=[0, 0, 0],
+    # Be explicit about sync rather than relying on platform defaults.
+    # The FBO also keeps the back buffer intact across flips, which lets
+    # draw_frame() hold a display without redrawing it (see there).
+    waitBlanking=True,
+    winType="pyglet",
+    useFBO=True,
+    # The refresh rate is measured once below instead: with checkTiming the
+    # window silently falls back to 60 Hz when its measurement fails
+    checkTiming=False,
 )
 
+# Measure the refresh rate once so every period below can be timed in
+# frames rather than by polling a clock.
+fps = win.getActualFrameRate()
+if fps is None:
+    print("Warning: Could not measure frame rate, assuming 60 Hz")
+    fps = 60.0
+
+# Any flip later than one refresh plus 4 ms is logged as a dropped frame
+win.refreshThreshold = 1.0 / fps + 0.004
+
+n_frames_letters = int(round(0.2 * fps))
+n_frames_max = int(round(1.5 * fps))
+
 # =========================
 # Stimuli Setup
 # =========================
@@ -48,12 +85,6 @@ win = visual.Window(
 # Fixation cross
 fixation = visual.TextStim(win, text="+", height=40, color=[1, 1, 1])
 
-# Background image stimulus (will be updated per trial)
-bg_image = visual.ImageStim(win, size=(800, 1200))
-
-# Letter string stimulus
-letter_stim = visual.TextStim(win, text="", height=60, color=[1, 1, 1])
-
 # Instruction and thanks texts
 instruction_text = visual.TextStim(
     win,
@@ -92,24 +123,180 @@ thanks_text = visual.TextStim(
 
 bgFolder = "backgrounds"
 
-backgroundTypes = ["ai", "internet", "paper", "solid"]
-bgImages = {}
+
+class BG(IntEnum):
+    """Background types; the value indexes bgStims, the lowercase name is the folder."""
+    AI = 0
+    INTERNET = 1
+    PAPER = 2
+    SOLID = 3
+
+
+backgroundTypes = [bg.name.lower() for bg in BG]
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def folder_mtimes(folder):
+    """Return the modification time of every type folder, or None if missing."""
+    root = Path(folder)
+    mtimes = {}
+    for bg_type in backgroundTypes:
+        type_dir = root / bg_type
+        mtimes[bg_type] = type_dir.stat().st_mtime if type_dir.is_dir() else None
+    return mtimes
+
+
+def load_or_build_manifest(folder):
+    """Return per-type (mtimes, images, fresh), reusing manifest.json if current."""
+    # The manifest is only written later, by write_manifest(), because the
+    # .npy caches built afterwards change the type folders' mtimes.
+    manifest_path = Path(folder) / "manifest.json"
+    mtimes = folder_mtimes(folder)
+
+    if manifest_path.is_file():
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            # Still valid as long as no type folder has changed since
+            if manifest.get("mtimes") == mtimes:
+                return mtimes, manifest["images"], True
+        except (OSError, ValueError, KeyError):
+            pass
+
+    images = {}
+    for bg_type in backgroundTypes:
+        if mtimes[bg_type] is None:
+            images[bg_type] = []
+            continue
+        folder_path = os.path.join(folder, bg_type)
+        images[bg_type] = sorted(
+            os.path.join(folder_path, f)
+            for f in os.listdir(folder_path)
+            if f.lower().endswith(image_extensions)
+        )
+
+    return mtimes, images, False
+
+
+def write_manifest(folder, images):
+    """Save images to manifest.json together with the current folder mtimes."""
+    manifest_path = Path(folder) / "manifest.json"
+    try:
+        with open(manifest_path, mode="w", encoding="utf-8") as f:
+            json.dump({"mtimes": folder_mtimes(folder), "images": images}, f, indent=2)
+    except OSError as e:
+        print(f"Warning: Could not write background manifest {manifest_path}: {e}")
+
+
+bgMtimes, bgImages, bgManifestFresh = load_or_build_manifest(bgFolder)
 
 for bg_type in backgroundTypes:
     folder_path = os.path.join(bgFolder, bg_type)
-    if not os.path.isdir(folder_path):
+    if bgMtimes[bg_type] is None:
         print(f"Warning: Folder not found for background type '{bg_type}': {folder_path}")
-        bgImages[bg_type] = []
-        continue
+    elif len(bgImages[bg_type]) == 0:
+        print(f"Warning: No image files found for background type '{bg_type}' in {folder_path}")
 
-    files = [
-        os.path.join(folder_path, f)
-        for f in os.listdir(folder_path)
-        if f.lower().endswith((".png", ".jpg", ".jpeg", ".bmp"))
+bg_size = (800, 1200)
+
+
+def fresh_cache_path(path):
+    """Return the .npy cache path for an image if it is up to date, else None."""
+    cache_path = path + ".npy"
+    if (
+        os.path.isfile(cache_path)
+        and os.path.getmtime(cache_path) >= os.path.getmtime(path)
+    ):
+        return cache_path
+    return None
+
+
+# Ask the kernel to start reading the files the stimuli below will load
+# into the page cache now: the .npy cache where one is up to date, the
+# source image otherwise.
+if hasattr(os, "posix_fadvise"):
+    for files in bgImages.values():
+        for path in files:
+            try:
+                fd = os.open(fresh_cache_path(path) or path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+
+def load_background_array(path):
+    """Return the image at path as an RGB uint8 array resized to bg_size.
+
+    The result is cached beside the original as path + ".npy".
+    """
+    cache_path = path + ".npy"
+    if fresh_cache_path(path) is not None:
+        try:
+            return np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            # Fall through and decode the source again
+            print(f"Warning: Ignoring unreadable image cache {cache_path}: {e}")
+
+    img = Image.open(path).convert("RGB").resize(bg_size, Image.BILINEAR)
+    arr = np.asarray(img)
+    # Write to a temporary file and move it into place so an interrupted
+    # write never leaves a truncated cache. The name is unique per process
+    # and thread; plain open() keeps the usual umask permissions so other
+    # accounts on the machine can read the cache.
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not cache decoded image {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return arr
+
+
+# Remove temporary cache files left behind by a run killed mid-write
+for files in bgImages.values():
+    for path in files:
+        for tmp_path in glob.glob(glob.escape(path) + ".npy.*.tmp"):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+# Decode (or memory-map) all backgrounds in parallel. Pillow releases the
+# GIL while decoding, so threads scale with the number of cores.
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    bgArrays = {
+        bg_type: list(executor.map(load_background_array, bgImages[bg_type]))
+        for bg_type in backgroundTypes
+    }
+
+# Writing the caches changes the type folders' mtimes, so the manifest is
+# saved only now, keyed on the mtimes the next run will actually see.
+if not bgManifestFresh or folder_mtimes(bgFolder) != bgMtimes:
+    write_manifest(bgFolder, bgImages)
+
+# Build one ImageStim per file up front so the texture upload happens here
+# rather than inside a trial. This stays on the main thread, which owns the
+# GL context. The arrays are wrapped back into PIL images because ImageStim
+# expects numpy textures in the -1..1 range with the origin at the bottom.
+bgStims = [[] for _ in BG]
+
+for bg in BG:
+    bgStims[bg] = [
+        visual.ImageStim(
+            win,
+            image=Image.fromarray(arr),
+            size=bg_size,
+            interpolate=True,
+        )
+        for arr in bgArrays[bg.name.lower()]
     ]
-    if len(files) == 0:
-        print(f"Warning: No image files found for background type '{bg_type}' in {folder_path}")
-    bgImages[bg_type] = files
 
 # =========================
 # Trial Structure
@@ -127,28 +314,45 @@ loads = ["low", "high"]
 # Letter sets
 target_letter = "X"
 non_target_letters = [l for l in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" if l != target_letter]
+non_target_arr = np.array(non_target_letters, dtype="U1")
+
+# Keys accepted during the response window
+RESPONSE_KEYS = ("z", "m", "escape")
 
 # We will control presence/absence:
 # aim: 3 target-present, 2 target-absent per condition (approx).
 
-trials = []
+# Shared generator for trial order, letter strings, jitters and background
+# picks. It is seeded from the participant and session so a session can be
+# reproduced exactly; the seed is also saved with every result row.
+trial_seed = zlib.crc32(f"{exp_info['Participant']}|{exp_info['Session']}".encode("utf-8"))
+rng = np.random.default_rng(trial_seed)
 
-for load in loads:
-    for bg_type in backgroundTypes:
-        # For each cell, create 5 trials:
-        # We'll add a flag 'target_present': True/False
-        # 3 True, 2 False
-        cell_trials = [True, True, True, False, False]
-        random.shuffle(cell_trials)
-        for present in cell_trials:
-            trials.append({
-                "load": load,
-                "background_type": bg_type,
-                "target_present": present
-            })
+# Each cell gets 3 True, 2 False for 'target_present'
+cell_presence = np.array([True, True, True, False, False])
+cells = list(product(loads, backgroundTypes))
+n_per_cell = len(cell_presence)
+
+trial_table = np.empty(
+    len(cells) * n_per_cell,
+    dtype=[("load", "U4"), ("background_type", "U8"), ("target_present", "?")],
+)
+trial_table["load"] = np.repeat([load for load, _ in cells], n_per_cell)
+trial_table["background_type"] = np.repeat([bg for _, bg in cells], n_per_cell)
+trial_table["target_present"] = np.tile(cell_presence, len(cells))
 
 # Randomize order
-random.shuffle(trials)
+trial_table = trial_table[rng.permutation(len(trial_table))]
+
+trials = [
+    {
+        "load": str(row["load"]),
+        "background_type": str(row["background_type"]),
+        "bg_idx": BG[str(row["background_type"]).upper()],
+        "target_present": bool(row["target_present"]),
+    }
+    for row in trial_table
+]
 
 # =========================
 # Trial Count Check
@@ -161,47 +365,109 @@ print(f"Total trials: {len(trials)}")
 # Helper Functions
 # =========================
 
-def make_letter_string(load_type, target_present):
-    """Create a 6-letter string based on load and target presence."""
+def make_letter_string(load_type, target_present, rng):
+    """Create a 6-letter string based on load and target presence, drawing from rng."""
     if load_type == "low":
         # Low load: if target present, XXXXX, else all same non-X letter
         if target_present:
             return target_letter * 6
         else:
             # all the same, but different from X
-            letter = random.choice(non_target_letters)
-            return letter * 6
+            letter = non_target_arr[rng.integers(len(non_target_arr))]
+            return str(letter) * 6
     else:
         # High load:
         #  - 1 target X + 5 different non-target letters (if present)
         #  - 6 non-target letters (none are X) if absent
-        letters = []
         if target_present:
-            letters.append(target_letter)
             # pick 5 distinct non-targets
-            chosen = random.sample(non_target_letters, 5)
-            letters.extend(chosen)
+            chosen = rng.choice(non_target_arr, 5, replace=False)
+            letters = np.append(chosen, target_letter)
         else:
             # 6 non-target letters, all distinct or at least not X
-            chosen = random.sample(non_target_letters, 6)
-            letters.extend(chosen)
-        random.shuffle(letters)
-        return "".join(letters)
+            letters = rng.choice(non_target_arr, 6, replace=False)
+        rng.shuffle(letters)
+        return "".join(letters.tolist())
+
+
+# Generate every trial's letter string and fixation jitter up front so
+# no RNG work happens inside the trial loop.
+for trial in trials:
+    trial["letters"] = make_letter_string(trial["load"], trial["target_present"], rng)
+    trial["jitter"] = float(rng.uniform(3.5, 5.5))  # seconds
 
 
-def get_background_image(bg_type):
-    """Pick a random image path from the given type."""
-    files = bgImages.get(bg_type, [])
-    if not files:
+def get_background_stim(bg_idx, rng):
+    """Pick a random pre-built background stimulus of the given BG type from rng."""
+    stims = bgStims[bg_idx]
+    if not stims:
         return None
-    return random.choice(files)
+    return stims[rng.integers(len(stims))]
+
+
+def draw_frame(stims, changed):
+    """Prepare the back buffer for the next flip(clearBuffer=False).
+
+    With an FBO the back buffer survives each flip, so stims are only
+    redrawn when the frame's content has changed. Without one (the window
+    falls back to plain double buffering if the FBO cannot be created) the
+    back buffer is undefined after a swap, so stims are redrawn every frame.
+    """
+    if changed or not win.useFBO:
+        win.clearBuffer()
+        for stim in stims:
+            stim.draw()
 
 
 # =========================
-# Data Logging
+# Letter String Stimuli
+# =========================
+
+# Every trial's letter string is known in advance, so each unique string
+# gets its own TextBox2 laid out once here. Trials just draw the cached
+# stimulus instead of re-laying out glyphs on a text change.
+text_cache = {
+    letters: visual.TextBox2(
+        win,
+        text=letters,
+        font="Arial",
+        letterHeight=60,
+        color=[1, 1, 1],
+        size=(800, 100),
+        alignment="center",
+        autoLog=False,
+    )
+    for letters in {trial["letters"] for trial in trials}
+}
+
+# =========================
+# Warm-up
 # =========================
 
-results = []
+# Draw every stimulus configuration once before the measured trials so
+# lazy texture uploads, shader setup and glyph rendering happen here
+# instead of on a trial's first frame. The buffer is cleared before each
+# flip, so the screen stays blank. The letter strings come from the
+# precomputed trials, leaving the seeded generator untouched.
+warmup_letters = {trial["load"]: trial["letters"] for trial in trials}
+
+fixation.draw()
+for text_stim in text_cache.values():
+    text_stim.draw()
+win.clearBuffer()
+win.flip()
+
+for stims in bgStims:
+    for stim in stims:
+        for letters in warmup_letters.values():
+            stim.draw()
+            text_cache[letters].draw()
+            win.clearBuffer()
+            win.flip()
+
+# =========================
+# Data Logging
+# =========================
 
 # Output file
 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -209,6 +475,64 @@ filename_base = f"ai_background_load_results_v4_{exp_info['Participant']}_{times
 out_dir = "data"
 os.makedirs(out_dir, exist_ok=True)
 filepath = os.path.join(out_dir, filename_base)
+frames_filepath = os.path.splitext(filepath)[0] + "_frames.json"
+
+# Results are held in a preallocated, typed table with one row per trial.
+# The design columns are known up front; the response columns are filled
+# in as each trial completes.
+n_trials = len(trials)
+results = pd.DataFrame({
+    "participant": pd.Series([exp_info["Participant"]] * n_trials, dtype="string"),
+    "session": pd.Series([exp_info["Session"]] * n_trials, dtype="string"),
+    "trial_index": pd.Series(range(1, n_trials + 1), dtype="int16"),
+    "load": pd.Series([t["load"] for t in trials], dtype="string"),
+    "background_type": pd.Series([t["background_type"] for t in trials], dtype="string"),
+    "target_present": pd.Series([int(t["target_present"]) for t in trials], dtype="int8"),
+    "letters": pd.Series([t["letters"] for t in trials], dtype="string"),
+    "response_key": pd.Series([""] * n_trials, dtype="string"),
+    "rt": pd.Series([np.nan] * n_trials, dtype="float64"),
+    "correct": pd.Series([0] * n_trials, dtype="int8"),
+    "seed": pd.Series([trial_seed] * n_trials, dtype="int64"),
+})
+
+
+def write_frame_log():
+    """Save the recorded frame intervals as a JSON sidecar to the CSV."""
+    intervals = list(win.frameIntervals)
+    # scheduled_frames absorb the fixation bookkeeping, so lateness there is
+    # expected; only the other intervals count as dropped. The PsychoPy
+    # total including them is kept as n_dropped_frames_total.
+    scheduled = set(scheduled_frames)
+    dropped_frames = [
+        k for k, interval in enumerate(intervals)
+        if interval > win.refreshThreshold and k not in scheduled
+    ]
+    frame_log = {
+        "fps": fps,
+        "refresh_threshold": win.refreshThreshold,
+        "n_dropped_frames": len(dropped_frames),
+        "n_dropped_frames_total": win.nDroppedFrames,
+        "dropped_frames": dropped_frames,
+        "scheduled_frames": scheduled_frames,
+        # Index into frame_intervals at which each trial began
+        "trial_frame_starts": trial_frame_starts,
+        "frame_intervals": intervals,
+    }
+    with open(frames_filepath, mode="w", encoding="utf-8") as f:
+        json.dump(frame_log, f)
+
+
+def write_result(row, response_key, rt, correct):
+    """Fill in a trial's response in the results table and append it to the CSV."""
+    results.loc[row, ["response_key", "rt", "correct"]] = (
+        response_key if response_key is not None else "",
+        rt if rt is not None else np.nan,
+        correct,
+    )
+    results.iloc[[row]].to_csv(csvfile, header=False, index=False)
+    csvfile.flush()
+    os.fsync(csvfile.fileno())
+
 
 # =========================
 # Instructions
@@ -227,100 +551,128 @@ if "escape" in keys:
 # =========================
 
 global_clock = core.Clock()
-trial_clock = core.Clock()
-
-for i, trial in enumerate(trials, start=1):
-    load_type = trial["load"]
-    bg_type = trial["background_type"]
-    target_present = trial["target_present"]
-
-    # -------------------------
-    # Fixation
-    # -------------------------
-    jitter = random.uniform(3.5, 5.5)  # seconds
-    fixation_time = jitter
-    trial_clock.reset()
-    while trial_clock.getTime() < fixation_time:
-        fixation.draw()
-        win.flip()
-
-    # -------------------------
-    # Choose background image
-    # -------------------------
-    img_path = get_background_image(bg_type)
-    if img_path is not None:
-        bg_image.image = img_path
-    else:
-        # fallback: plain grey if no image is found
-        bg_image.image = None
-        win.color = [0, 0, 0]
-
-    # -------------------------
-    # Create letter string for this trial
-    # -------------------------
-    letters = make_letter_string(load_type, target_present)
-    letter_stim.text = letters
-
-    # -------------------------
-    # Present background + letters
-    # -------------------------
-    event.clearEvents()
-    trial_clock.reset()
-    rt = None
-    response_key = None
-    correct = None
-
-    # Part 1: 200 ms with letters + background
-    while trial_clock.getTime() < 0.2:
-        if img_path is not None:
-            bg_image.draw()
-        letter_stim.draw()
-        win.flip()
-        # Collect response during this window (if any)
-        keys = event.getKeys(keyList=["z", "m", "escape"], timeStamped=trial_clock)
-        if keys and response_key is None:
-            response_key, rt = keys[0]
-
-    # Part 2: after 200 ms, letters disappear, background remains
-    # Continue till response or max 1.5 s from letter onset
-    max_dur = 1.5
-    while trial_clock.getTime() < max_dur and response_key is None:
-        if img_path is not None:
-            bg_image.draw()
-        win.flip()
-        keys = event.getKeys(keyList=["z", "m", "escape"], timeStamped=trial_clock)
-        if keys and response_key is None:
-            response_key, rt = keys[0]
-
-    # Check for escape
-    if response_key == "escape":
-        break
-
-    # Determine correctness
-    if response_key is None:
-        correct = 0
-    else:
-        # 'z' = target present, 'm' = target absent
-        if target_present and response_key == "z":
-            correct = 1
-        elif (not target_present) and response_key == "m":
-            correct = 1
-        else:
-            correct = 0
 
-    # Store trial data
-    results.append({
-        "participant": exp_info["Participant"],
-        "session": exp_info["Session"],
-        "trial_index": i,
-        "load": load_type,
-        "background_type": bg_type,
-        "target_present": int(target_present),
-        "letters": letters,
-        "response_key": response_key if response_key is not None else "",
-        "rt": rt if rt is not None else "",
-        "correct": correct
-    })
+# Responses come from the hardware keyboard, whose timestamps are taken at
+# key-down rather than when the buffer is polled. RT is read against
+# kb.clock, which is reset on the letter-onset flip.
+kb = keyboard.Keyboard(bufferSize=10, waitForStart=False)
+
+# Rows are streamed to disk as the session runs so a crash loses little
+# more than the trial in progress. Each row is written during the next fixation,
+# where fsync latency cannot overlap the stimulus.
+csvfile = open(filepath, mode="w", newline="", encoding="utf-8")
+results.iloc[:0].to_csv(csvfile, index=False)
+csvfile.flush()
+pending_row = None
+
+# Record every flip interval from here on for the frame log
+trial_frame_starts = []
+scheduled_frames = []
+win.recordFrameIntervals = True
+
+# Keep the collector and other processes from interrupting stimulus
+# presentation; garbage is reaped explicitly during fixation instead.
+core.rush(True)
+gc.disable()
+
+try:
+    for i, trial in enumerate(trials, start=1):
+        load_type = trial["load"]
+        bg_idx = trial["bg_idx"]
+        target_present = trial["target_present"]
+        trial_frame_starts.append(len(win.frameIntervals))
+
+        # -------------------------
+        # Fixation
+        # -------------------------
+        n_frames_fixation = int(round(trial["jitter"] * fps))
+        # Draw once and keep the back buffer between flips instead of
+        # redrawing identical content every frame.
+        for frame in range(n_frames_fixation):
+            draw_frame([fixation], changed=(frame == 0))
+            win.flip(clearBuffer=False)
+            if frame == 0:
+                # Fixation timing is lax, so reap garbage and save the
+                # previous trial here. This may delay the next flip, so
+                # that interval is logged as scheduled rather than dropped.
+                scheduled_frames.append(len(win.frameIntervals))
+                gc.collect()
+                if pending_row is not None:
+                    write_result(*pending_row)
+                    pending_row = None
+
+        # -------------------------
+        # Choose background image
+        # -------------------------
+        bg_stim = get_background_stim(bg_idx, rng)
+        if bg_stim is None:
+            # fallback: plain grey if no image is found
+            win.color = [0, 0, 0]
+
+        # -------------------------
+        # Look up letter string for this trial
+        # -------------------------
+        letter_stim = text_cache[trial["letters"]]
+
+        # -------------------------
+        # Present background + letters
+        # -------------------------
+        rt = None
+        response_key = None
+        correct = None
+
+        # Letters + background for the first 200 ms, then background only
+        # until a response or 1.5 s from letter onset. One frame-counted
+        # loop covers both; the screen is only redrawn at letter offset.
+        bg_frame = [bg_stim] if bg_stim is not None else []
+        letter_frame = bg_frame + [letter_stim]
+        # RT is measured from the flip that actually shows the letters, and
+        # any key pressed before that flip is discarded on the same flip
+        win.callOnFlip(kb.clock.reset)
+        win.callOnFlip(kb.clearEvents, eventType="keyboard")
+        # Frame 0 is the onset flip, so flip n_frames_max lands at 1.5 s and
+        # the poll after it still collects keys pressed in the last frame.
+        for frame in range(n_frames_max + 1):
+            if frame < n_frames_letters:
+                draw_frame(letter_frame, changed=(frame == 0))
+            else:
+                # The letters always stay up for the full 200 ms
+                if response_key is not None:
+                    break
+                draw_frame(bg_frame, changed=(frame == n_frames_letters))
+            win.flip(clearBuffer=False)
+            keys = kb.getKeys(keyList=RESPONSE_KEYS, waitRelease=False)
+            if keys and response_key is None:
+                response_key, rt = keys[0].name, keys[0].rt
+
+        # Check for escape
+        if response_key == "escape":
+            break
+
+        # Determine correctness
+        if response_key is None:
+            correct = 0
+        else:
+            # 'z' = target present, 'm' = target absent
+            if target_present and response_key == "z":
+                correct = 1
+            elif (not target_present) and response_key == "m":
+                correct = 1
+            else:
+                correct = 0
+
+        # Store trial data; the (comparatively slow) table update and CSV
+        # write happen in the next fixation's scheduled frame
+        pending_row = (i - 1, response_key, rt, correct)
+finally:
+    if pending_row is not None:
+        write_result(*pending_row)
+    csvfile.close()
+    win.recordFrameIntervals = False
+    write_frame_log()
+    gc.collect()
+    gc.enable()
+    core.rush(False)
 
 # =========================
 # End of Experiment
@@ -330,24 +682,7 @@ thanks_text.draw()
 win.flip()
 core.wait(3.0)
 
+print(f"Data saved to {filepath}")
+
 win.close()
 core.quit()
-
-# =========================
-# Save Data to CSV
-# (Executed after window close)
-# =========================
-
-fieldnames = [
-    "participant", "session", "trial_index",
-    "load", "background_type", "target_present",
-    "letters", "response_key", "rt", "correct"
-]
-
-with open(filepath, mode="w", newline="", encoding="utf-8") as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    for row in results:
-        writer.writerow(row)
-
-print(f"Data saved to {filepath}")